@@ -1,18 +1,23 @@
 import os
+import asyncio
 import sqlite3
-import json
 import base64
+import io
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
+import aiosqlite
 import httpx
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from PIL import Image
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
-
 # -----------------------------------------
 # CONFIGURATION
 # -----------------------------------------
@@ -20,11 +25,40 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
 DB_NAME = "dental_bot.db"
+# WAL allows many readers alongside a single writer
+DB_READ_POOL_SIZE = 6
+
+# Applied to every pooled connection (journal_mode=WAL is persisted by init_db)
+DB_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=5000;
+"""
 
 # Dubai timezone (UTC+4)
 DUBAI_TZ = timezone(timedelta(hours=4))
 
+# Daily Dubai time at which the background task rolls the slot window forward
+SLOTS_REFRESH_AT = (0, 5)
+
+# How long a registered user's row is served from memory
+USER_CACHE_TTL = 300
+
+# Largest photo resolution we forward to Gemini
+MAX_PHOTO_BYTES = 4 * 1024 * 1024
+
+# Telegram allows ~30 messages/s overall and ~1 message/s per chat
+OUTBOX_RATE = 25
+OUTBOX_CHAT_INTERVAL = 1.0
+OUTBOX_CONCURRENCY = 25
+
+# Webhook updates handled at once; further ones wait for a free slot
+UPDATE_CONCURRENCY = 200
+
 if not TELEGRAM_TOKEN:
     print("❌ ERROR: TELEGRAM_BOT_TOKEN is missing!")
 if not GOOGLE_API_KEY:
@@ -40,6 +74,27 @@ LANG_NAMES = {
     "ru": "Russian",
 }
 
+IMAGE_PROMPT = (
+    "Analyze this dental image. Identify possible issues (cavities, gum problems, alignment, etc.). "
+    "Be professional and clear. This is NOT a diagnosis."
+)
+IMAGE_PROMPTS = {
+    lang: IMAGE_PROMPT if name == "English" else f"{IMAGE_PROMPT} Answer in {name}."
+    for lang, name in LANG_NAMES.items()
+}
+
+# Casefolded words a user may send (or tap) to pick a language
+LANG_MAP = {
+    "فارسی": "fa",
+    "farsi": "fa",
+    "english": "en",
+    "العربية": "ar",
+    "arabic": "ar",
+    "русский": "ru",
+    "russian": "ru",
+}
+LANG_BUTTONS = frozenset({"فارسی / Farsi", "English", "العربية / Arabic", "Русский / Russian"})
+
 # -----------------------------------------
 # TRANSLATIONS (4 Languages)
 # -----------------------------------------
@@ -186,12 +241,34 @@ TRANS = {
     },
 }
 
+# Main menu button text -> position in the flattened keyboard, per language
+BUTTON_INDEX = {
+    lang: {b: i for i, b in enumerate([x for row in t["buttons"] for x in row])}
+    for lang, t in TRANS.items()
+}
+
+# Every language's menu button labels, for resetting flows on any menu tap
+MENU_BUTTONS = frozenset(b for index in BUTTON_INDEX.values() for b in index)
+
+# Bound per-language reminder formatters, with the alarm prefix already applied
+REMINDER_FMT = {lang: ("⏰ " + t["reminder_msg"]).format for lang, t in TRANS.items()}
+
 # -----------------------------------------
 # DATABASE
 # -----------------------------------------
+def future_slot_rows(now):
+    return [
+        (f"{(now + timedelta(days=day)).strftime('%Y-%m-%d')} {hour:02d}:00",)
+        for day in range(1, 8)
+        for hour in [10, 12, 14, 16, 18, 20]
+    ]
+
+
 def init_db():
     with sqlite3.connect(DB_NAME) as conn:
         conn.execute("PRAGMA journal_mode=WAL;")
+        # Schema and the first week of slots land in one transaction
+        conn.execute("BEGIN")
         conn.execute(
             "CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, name TEXT, whatsapp TEXT, phone TEXT, lang TEXT DEFAULT 'fa')"
         )
@@ -209,108 +286,226 @@ def init_db():
             )
         """
         )
+        # Free-slot listing and tomorrow's-reminder scans
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_slots_avail ON slots(is_booked, datetime_str)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_slots_reminder ON slots(reminder_sent, datetime_str) "
+            "WHERE is_booked=1"
+        )
+        now = datetime.now(DUBAI_TZ)
+        conn.executemany(
+            "INSERT OR IGNORE INTO slots (datetime_str) VALUES (?)", future_slot_rows(now)
+        )
+        yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+        conn.execute("DELETE FROM slots WHERE datetime_str < ?", (yesterday,))
         conn.commit()
-    ensure_future_slots()
 
 
-def ensure_future_slots():
-    with sqlite3.connect(DB_NAME) as conn:
+async def open_db_pool(size, query_only=False):
+    # Long-lived connections keep SQLite's page cache warm between webhooks
+    pool = asyncio.Queue()
+    try:
+        for _ in range(size):
+            conn = await aiosqlite.connect(DB_NAME)
+            pool.put_nowait(conn)
+            await conn.executescript(DB_PRAGMAS)
+            if query_only:
+                await conn.execute("PRAGMA query_only=1")
+    except BaseException:
+        # Each connection owns a thread; leaking one keeps the process alive
+        await close_db_pool(pool)
+        raise
+    return pool
+
+
+async def close_db_pool(pool):
+    while not pool.empty():
+        await pool.get_nowait().close()
+
+
+@asynccontextmanager
+async def db_connection(pool):
+    conn = await pool.get()
+    try:
+        yield conn
+    except BaseException:
+        await conn.rollback()
+        raise
+    finally:
+        pool.put_nowait(conn)
+
+
+async def ensure_future_slots():
+    async with db_connection(app.state.write_pool) as conn:
         now = datetime.now(DUBAI_TZ)
-        for day in range(1, 8):
-            date = now + timedelta(days=day)
-            for hour in [10, 12, 14, 16, 18, 20]:
-                dt_str = f"{date.strftime('%Y-%m-%d')} {hour:02d}:00"
-                try:
-                    conn.execute("INSERT INTO slots (datetime_str) VALUES (?)", (dt_str,))
-                except Exception:
-                    pass
+        # Existing slots hit the UNIQUE index and are skipped by the engine
+        await conn.executemany(
+            "INSERT OR IGNORE INTO slots (datetime_str) VALUES (?)", future_slot_rows(now)
+        )
         yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
-        conn.execute("DELETE FROM slots WHERE datetime_str < ?", (yesterday,))
-        conn.commit()
+        await conn.execute("DELETE FROM slots WHERE datetime_str < ?", (yesterday,))
+        await conn.commit()
 
 
-def upsert_user(chat_id, name=None, whatsapp=None, phone=None, lang=None):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,))
-        if cursor.fetchone():
-            q = "UPDATE users SET "
-            params = []
-            if name:
-                q += "name=?, "
-                params.append(name)
-            if whatsapp:
-                q += "whatsapp=?, "
-                params.append(whatsapp)
-            if phone:
-                q += "phone=?, "
-                params.append(phone)
-            if lang:
-                q += "lang=?, "
-                params.append(lang)
-            if params:
-                q = q.rstrip(", ") + " WHERE chat_id=?"
-                params.append(chat_id)
-                conn.execute(q, tuple(params))
-        else:
-            conn.execute(
-                "INSERT INTO users (chat_id, name, whatsapp, phone, lang) VALUES (?,?,?,?,?)",
-                (chat_id, name, whatsapp, phone, lang or "fa"),
-            )
-        conn.commit()
+async def slots_refresher():
+    # Rolls the 7-day slot window forward once a day; startup already did the first pass
+    hour, minute = SLOTS_REFRESH_AT
+    while True:
+        now = datetime.now(DUBAI_TZ)
+        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await ensure_future_slots()
+        except Exception as e:
+            print(f"Slots Refresh Error: {e}")
 
 
-def get_user(chat_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        return conn.execute(
-            "SELECT name, whatsapp, phone, lang FROM users WHERE chat_id=?", (chat_id,)
-        ).fetchone()
+# chat_id -> (expires_at, user_row) for fully registered users. A chat's updates
+# are handled one at a time, so dropping the entry in upsert_user keeps it fresh.
+USER_CACHE = {}
 
 
-def get_all_users():
-    with sqlite3.connect(DB_NAME) as conn:
-        return [r[0] for r in conn.execute("SELECT chat_id FROM users").fetchall()]
+async def upsert_user(chat_id, name=None, whatsapp=None, phone=None, lang=None, clear_state=False):
+    # None keeps the stored value; new users default to Persian
+    async with db_connection(app.state.write_pool) as conn:
+        await conn.execute(
+            """
+            INSERT INTO users (chat_id, name, whatsapp, phone, lang)
+            VALUES (?1, ?2, ?3, ?4, COALESCE(?5, 'fa'))
+            ON CONFLICT(chat_id) DO UPDATE SET
+                name=COALESCE(?2, name),
+                whatsapp=COALESCE(?3, whatsapp),
+                phone=COALESCE(?4, phone),
+                lang=COALESCE(?5, lang)
+            """,
+            (chat_id, name, whatsapp, phone, lang),
+        )
+        if clear_state:
+            await conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
+        await conn.commit()
+    USER_CACHE.pop(chat_id, None)
+
+
+async def load_context(chat_id):
+    # User row and in-progress flow state in one round trip; either may be None
+    now = time.monotonic()
+    cached = USER_CACHE.get(chat_id)
+    if cached and cached[0] > now:
+        async with db_connection(app.state.read_pool) as conn:
+            cursor = await conn.execute(
+                "SELECT flow_type, step, data FROM states WHERE chat_id=?", (chat_id,)
+            )
+            state_row = await cursor.fetchone()
+        return cached[1], state_row
+
+    async with db_connection(app.state.read_pool) as conn:
+        cursor = await conn.execute(
+            """
+            SELECT u.chat_id, u.name, u.whatsapp, u.phone, u.lang,
+                   s.chat_id, s.flow_type, s.step, s.data
+            FROM (SELECT ? AS cid) x
+            LEFT JOIN users u ON u.chat_id = x.cid
+            LEFT JOIN states s ON s.chat_id = x.cid
+            """,
+            (chat_id,),
+        )
+        row = await cursor.fetchone()
+    user_row = row[1:5] if row[0] is not None else None
+    state_row = row[6:9] if row[5] is not None else None
+    # Only rows with a verified phone are final enough to cache
+    if user_row and user_row[2]:
+        if len(USER_CACHE) > 10000:
+            USER_CACHE.clear()
+        USER_CACHE[chat_id] = (now + USER_CACHE_TTL, user_row)
+    return user_row, state_row
+
+
+async def get_all_users():
+    async with db_connection(app.state.read_pool) as conn:
+        rows = await conn.execute_fetchall("SELECT chat_id FROM users")
+        return [r[0] for r in rows]
+
+
+async def set_state(chat_id, flow_type, step, data):
+    async with db_connection(app.state.write_pool) as conn:
+        await conn.execute(
+            "INSERT OR REPLACE INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
+            (chat_id, flow_type, step, orjson.dumps(data).decode()),
+        )
+        await conn.commit()
+
+
+async def update_state(chat_id, step, changes):
+    # Merges changes into the stored data in SQL and returns the merged dict, or
+    # None if the chat has no flow state. Callers only use it on the flow they
+    # just loaded, which can't be cleared meanwhile since a chat's updates are serialized.
+    async with db_connection(app.state.write_pool) as conn:
+        cursor = await conn.execute(
+            "UPDATE states SET step=?, data=json_patch(COALESCE(data, '{}'), ?) "
+            "WHERE chat_id=? RETURNING data",
+            (step, orjson.dumps(changes).decode(), chat_id),
+        )
+        row = await cursor.fetchone()
+        await conn.commit()
+        return orjson.loads(row[0]) if row else None
 
 
-def get_available_slots():
-    ensure_future_slots()
-    with sqlite3.connect(DB_NAME) as conn:
-        now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
-        return [
-            r[0]
-            for r in conn.execute(
-                "SELECT datetime_str FROM slots WHERE is_booked=0 AND datetime_str > ? "
-                "ORDER BY datetime_str ASC LIMIT 10",
-                (now_str,),
-            ).fetchall()
-        ]
+async def clear_state(chat_id):
+    async with db_connection(app.state.write_pool) as conn:
+        await conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
+        await conn.commit()
 
 
-def book_slot_atomic(dt_str, chat_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.execute(
-            "UPDATE slots SET is_booked=1, booked_by=? WHERE datetime_str=? AND is_booked=0",
-            (chat_id, dt_str),
+async def get_available_slots():
+    async with db_connection(app.state.read_pool) as conn:
+        now_str = datetime.now(DUBAI_TZ).strftime("%Y-%m-%d %H:%M")
+        rows = await conn.execute_fetchall(
+            "SELECT datetime_str FROM slots WHERE is_booked=0 AND datetime_str > ? "
+            "ORDER BY datetime_str ASC LIMIT 10",
+            (now_str,),
         )
-        conn.commit()
-        return cursor.rowcount > 0
+        return [r[0] for r in rows]
 
 
-def get_pending_reminders():
-    tomorrow = (datetime.now(DUBAI_TZ) + timedelta(days=1)).strftime("%Y-%m-%d")
-    with sqlite3.connect(DB_NAME) as conn:
+async def book_slot_atomic(dt_str, chat_id):
+    # Returns (id, datetime_str) or None. A successful booking also ends the
+    # user's booking flow in the same transaction.
+    async with db_connection(app.state.write_pool) as conn:
+        cursor = await conn.execute(
+            "UPDATE slots SET is_booked=1, booked_by=? "
+            "WHERE datetime_str=? AND is_booked=0 "
+            "RETURNING id, datetime_str",
+            (chat_id, dt_str),
+        )
+        row = await cursor.fetchone()
+        if row:
+            await conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
+        await conn.commit()
+        return row
+
+
+async def get_pending_reminders():
+    # Claims tomorrow's reminders: they are flagged as sent and returned in one statement
+    now = datetime.now(DUBAI_TZ)
+    start = (now + timedelta(days=1)).strftime("%Y-%m-%d 00:00")
+    end = (now + timedelta(days=2)).strftime("%Y-%m-%d 00:00")
+    async with db_connection(app.state.write_pool) as conn:
         q = """
-            SELECT slots.id, slots.datetime_str, users.chat_id, users.name, users.lang
-            FROM slots
-            JOIN users ON slots.booked_by = users.chat_id
-            WHERE is_booked=1 AND reminder_sent=0 AND datetime_str LIKE ?
+            UPDATE slots SET reminder_sent=1
+            WHERE is_booked=1 AND reminder_sent=0
+              AND datetime_str >= ? AND datetime_str < ?
+              AND booked_by IN (SELECT chat_id FROM users)
+            RETURNING id, datetime_str, booked_by,
+              (SELECT name FROM users WHERE chat_id=slots.booked_by),
+              (SELECT lang FROM users WHERE chat_id=slots.booked_by)
         """
-        return conn.execute(q, (f"{tomorrow}%",)).fetchall()
-
-
-def mark_reminder_as_sent(slot_id):
-    with sqlite3.connect(DB_NAME) as conn:
-        conn.execute("UPDATE slots SET reminder_sent=1 WHERE id=?", (slot_id,))
-        conn.commit()
+        rows = await conn.execute_fetchall(q, (start, end))
+        await conn.commit()
+        return rows
 
 
 # -----------------------------------------
@@ -327,30 +522,75 @@ async def send_message(chat_id: int, text: str, reply_markup: dict = None, parse
         if parse_mode:
             payload["parse_mode"] = parse_mode
 
-        async with httpx.AsyncClient(timeout=20) as client:
-            await client.post(f"{TELEGRAM_URL}/sendMessage", json=payload)
+        return await app.state.tg.post("/sendMessage", content=orjson.dumps(payload))
     except Exception as e:
         print(f"Send Error: {e}")
+        return None
+
+
+def queue_message(chat_id: int, text: str, reply_markup: dict = None):
+    # Non-urgent sends (admin notices, broadcasts, reminders) go through the outbox
+    app.state.outbox.put_nowait((chat_id, text, reply_markup))
+
+
+async def outbox_worker():
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    in_flight = set()
+    last_sent = {}
+    resume_at = 0.0
+
+    async def deliver(chat_id, text, reply_markup):
+        nonlocal resume_at
+        try:
+            r = await send_message(chat_id, text, reply_markup=reply_markup)
+            if r is not None and r.status_code == 429:
+                # Flood control: pause the whole outbox for as long as Telegram asks
+                retry_after = r.json().get("parameters", {}).get("retry_after", 1)
+                resume_at = max(resume_at, loop.time() + retry_after)
+                await asyncio.sleep(retry_after)
+                await send_message(chat_id, text, reply_markup=reply_markup)
+        except Exception as e:
+            print(f"Outbox Error: {e}")
+        finally:
+            sem.release()
+            app.state.outbox.task_done()
+
+    while True:
+        chat_id, text, reply_markup = await app.state.outbox.get()
+        now = loop.time()
+        wait = max(resume_at, last_sent.get(chat_id, 0) + OUTBOX_CHAT_INTERVAL) - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await sem.acquire()
+        task = asyncio.create_task(deliver(chat_id, text, reply_markup))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        now = loop.time()
+        last_sent[chat_id] = now
+        if len(last_sent) > 1000:
+            last_sent = {c: t for c, t in last_sent.items() if now - t < OUTBOX_CHAT_INTERVAL}
+        await asyncio.sleep(1 / OUTBOX_RATE)
 
 
 async def get_file_info(file_id):
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(f"{TELEGRAM_URL}/getFile?file_id={file_id}")
-            return r.json().get("result")
+        r = await app.state.tg.get("/getFile", params={"file_id": file_id})
+        return r.json().get("result")
     except Exception:
         return None
 
 
 async def call_gemini_api(body, lang: str = "en"):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
-    headers = {"Content-Type": "application/json", "x-goog-api-key": GOOGLE_API_KEY}
     texts = TRANS.get(lang, TRANS["en"])
+    if not GOOGLE_API_KEY:
+        # The rest of the bot keeps working without AI; startup already warned
+        return texts["ai_connection_error"]
     try:
-        async with httpx.AsyncClient(timeout=45) as client:
-            r = await client.post(url, headers=headers, json=body)
-            r.raise_for_status()
-            return r.json()["candidates"][0]["content"]["parts"][0]["text"]
+        # Image bodies carry megabytes of base64; orjson encodes them far faster
+        r = await app.state.gemini.post(GEMINI_URL, content=orjson.dumps(body))
+        r.raise_for_status()
+        return r.json()["candidates"][0]["content"]["parts"][0]["text"]
     except httpx.HTTPStatusError as e:
         error_msg = f"❌ AI Error {e.response.status_code}: {e.response.text}"
         print(error_msg)
@@ -360,27 +600,43 @@ async def call_gemini_api(body, lang: str = "en"):
         return texts["ai_connection_error"]
 
 
-async def analyze_image_with_gemini(file_path, caption, lang):
+async def download_file(file_path):
     file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+    data = bytearray()
+    async with app.state.tg.stream("GET", file_url, timeout=60) as r:
+        async for chunk in r.aiter_bytes(64 * 1024):
+            data += chunk
+            if len(data) > MAX_PHOTO_BYTES:
+                raise ValueError(f"file exceeds {MAX_PHOTO_BYTES} bytes")
+    return bytes(data)
+
+
+def prepare_image(img_data):
+    # WEBP is usually ~40% smaller than Telegram's JPEG; keep the JPEG if it isn't
+    mime_type = "image/jpeg"
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            img_data = (await client.get(file_url)).content
-        b64_img = base64.b64encode(img_data).decode("utf-8")
-
-        target_lang = LANG_NAMES.get(lang, "English")
-        prompt = (
-            "Analyze this dental image. Identify possible issues (cavities, gum problems, alignment, etc.). "
-            "Be professional and clear. This is NOT a diagnosis."
-        )
-        if target_lang != "English":
-            prompt += f" Answer in {target_lang}."
+        buf = io.BytesIO()
+        Image.open(io.BytesIO(img_data)).convert("RGB").save(buf, format="WEBP", quality=80)
+        if buf.tell() < len(img_data):
+            img_data, mime_type = buf.getvalue(), "image/webp"
+    except Exception as e:
+        print(f"WEBP Error: {e}")
+    return mime_type, base64.b64encode(img_data).decode("ascii")
+
 
+async def analyze_image_with_gemini(file_path, caption, lang):
+    try:
+        img_data = await download_file(file_path)
+        # Decoding, re-encoding and base64 are CPU work; keep them off the event loop
+        mime_type, b64_img = await asyncio.to_thread(prepare_image, img_data)
+
+        prompt = IMAGE_PROMPTS.get(lang, IMAGE_PROMPT)
         body = {
             "contents": [
                 {
                     "parts": [
                         {"text": f"{prompt}\nUser Question: {caption}"},
-                        {"inline_data": {"mime_type": "image/jpeg", "data": b64_img}},
+                        {"inline_data": {"mime_type": mime_type, "data": b64_img}},
                     ]
                 }
             ]
@@ -406,65 +662,119 @@ async def ask_gemini_text(question, lang):
 # -----------------------------------------
 # KEYBOARDS
 # -----------------------------------------
-def language_keyboard():
-    return {
-        "keyboard": [
-            [{"text": "فارسی / Farsi"}, {"text": "English"}],
-            [{"text": "العربية / Arabic"}, {"text": "Русский / Russian"}],
-        ],
+# Reply markups are static per language, so build them once and share them
+LANG_KB = {
+    "keyboard": [
+        [{"text": "فارسی / Farsi"}, {"text": "English"}],
+        [{"text": "العربية / Arabic"}, {"text": "Русский / Russian"}],
+    ],
+    "resize_keyboard": True,
+    "one_time_keyboard": True,
+}
+CONTACT_KB = {
+    lang: {
+        "keyboard": [[{"text": t["share_contact"], "request_contact": True}]],
         "resize_keyboard": True,
         "one_time_keyboard": True,
     }
+    for lang, t in TRANS.items()
+}
+CANCEL_ROW = {lang: [{"text": t["cancel_button"]}] for lang, t in TRANS.items()}
+MAIN_KB = {
+    lang: {
+        "keyboard": [[{"text": b} for b in row] for row in t["buttons"]],
+        "resize_keyboard": True,
+    }
+    for lang, t in TRANS.items()
+}
+
+
+def language_keyboard():
+    return LANG_KB
+
+
+def detect_language(text):
+    # Keyboard labels look like "فارسی / Farsi": try each side as an exact key first
+    key = text.casefold()
+    for token in key.split("/"):
+        lang = LANG_MAP.get(token.strip())
+        if lang:
+            return lang
+    return next((code for word, code in LANG_MAP.items() if word in key), None)
 
 
 def contact_keyboard(lang):
-    text = TRANS.get(lang, TRANS["en"])["share_contact"]
-    return {
-        "keyboard": [[{"text": text, "request_contact": True}]],
-        "resize_keyboard": True,
-        "one_time_keyboard": True,
-    }
+    return CONTACT_KB.get(lang, CONTACT_KB["en"])
 
 
 def main_keyboard(lang):
-    btns = TRANS.get(lang, TRANS["en"])["buttons"]
-    return {
-        "keyboard": [[{"text": b} for b in row] for row in btns],
-        "resize_keyboard": True,
-    }
+    return MAIN_KB.get(lang, MAIN_KB["en"])
 
 
+@lru_cache(maxsize=64)
 def slots_keyboard(slots, lang):
-    texts = TRANS.get(lang, TRANS["en"])
-    cancel_text = texts["cancel_button"]
-    kb = []
-    row = []
-    for s in slots:
-        # s format: "YYYY-MM-DD HH:MM" -> show "MM-DD HH:MM"
-        row.append({"text": s[5:]})
-        if len(row) == 2:
-            kb.append(row)
-            row = []
-    if row:
-        kb.append(row)
-    kb.append([{"text": cancel_text}])
+    # slots is a tuple so users offered the same window share one keyboard.
+    # "YYYY-MM-DD HH:MM" -> "MM-DD HH:MM", two buttons per row
+    kb = [[{"text": s[5:]} for s in slots[i : i + 2]] for i in range(0, len(slots), 2)]
+    kb.append(CANCEL_ROW.get(lang, CANCEL_ROW["en"]))
     return {"keyboard": kb, "resize_keyboard": True}
 
 
-def get_all_menu_buttons():
-    all_btns = []
-    for l in TRANS:
-        for row in TRANS[l]["buttons"]:
-            all_btns.extend(row)
-    return set(all_btns)
-
-
 # -----------------------------------------
 # ROUTES
 # -----------------------------------------
-@app.on_event("startup")
-def startup_event():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     init_db()
+    # Everything opened here is closed in reverse order, also when startup fails
+    async with AsyncExitStack() as stack:
+        app.state.read_pool = await open_db_pool(DB_READ_POOL_SIZE, query_only=True)
+        stack.push_async_callback(close_db_pool, app.state.read_pool)
+        app.state.write_pool = await open_db_pool(1)
+        stack.push_async_callback(close_db_pool, app.state.write_pool)
+        # Keep-alive HTTP/2 clients so TLS is not renegotiated per message
+        app.state.tg = await stack.enter_async_context(
+            httpx.AsyncClient(
+                base_url=TELEGRAM_URL,
+                headers={"Content-Type": "application/json"},
+                http2=True,
+                timeout=20,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            )
+        )
+        app.state.gemini = await stack.enter_async_context(
+            httpx.AsyncClient(
+                headers={"Content-Type": "application/json", "x-goog-api-key": GOOGLE_API_KEY or ""},
+                http2=True,
+                timeout=45,
+            )
+        )
+        app.state.update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+        app.state.chat_locks = {}
+        app.state.outbox = asyncio.Queue()
+        app.state.outbox_task = asyncio.create_task(outbox_worker())
+        stack.push_async_callback(stop_task, app.state.outbox_task)
+        app.state.slots_task = asyncio.create_task(slots_refresher())
+        stack.push_async_callback(stop_task, app.state.slots_task)
+
+        yield
+
+        # Give queued notifications a moment to go out before stopping the worker
+        try:
+            await asyncio.wait_for(app.state.outbox.join(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def stop_task(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -474,96 +784,138 @@ async def root():
 
 @app.get("/trigger-reminders")
 async def trigger_reminders():
-    reminders = get_pending_reminders()
-    count = 0
+    reminders = await get_pending_reminders()
     for slot_id, dt_str, chat_id, name, lang in reminders:
-        texts = TRANS.get(lang, TRANS["en"])
-        date_part = dt_str.split(" ")[0]
-        time_part = dt_str.split(" ")[1]
-        msg = f"⏰ {texts['reminder_msg'].format(name=name, date=date_part, time=time_part)}"
-        await send_message(chat_id, msg)
-        mark_reminder_as_sent(slot_id)
-        count += 1
-    return {"status": "success", "sent": count}
+        date_part, time_part = dt_str.split(" ")
+        msg = REMINDER_FMT.get(lang, REMINDER_FMT["en"])(name=name, date=date_part, time=time_part)
+        # The outbox delivers them concurrently within Telegram's rate limits
+        queue_message(chat_id, msg)
+    return {"status": "success", "sent": len(reminders)}
 
 
 @app.post("/webhook")
-async def webhook(request: Request):
+async def webhook(request: Request, background_tasks: BackgroundTasks):
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
     except Exception:
-        return {"ok": True}
+        return Response(status_code=204)
+    # Acknowledge right away; Gemini calls can take long enough for Telegram to redeliver
+    background_tasks.add_task(process_update, data)
+    # Telegram only looks at the status code, so skip encoding a body
+    return Response(status_code=204)
+
+
+async def process_update(data):
+    # One chat's updates run one at a time and in arrival order, since each step
+    # reads the flow state and writes it back across awaits. Different chats still
+    # run concurrently, bounded so a burst can't start unlimited DB/Gemini work.
+    chat_id = data.get("message", {}).get("chat", {}).get("id")
+    locks = app.state.chat_locks
+    # chat_id -> [lock, updates holding or waiting for it]; dropped once idle
+    entry = locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0], app.state.update_slots:
+            await handle_update(data)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del locks[chat_id]
+
+
+def menu_reply(key):
+    async def reply(chat_id, lang, texts, prefix):
+        await send_message(
+            chat_id, f"{prefix}\n{texts[key]}", reply_markup=main_keyboard(lang)
+        )
+
+    return reply
+
+
+async def menu_booking(chat_id, lang, texts, prefix):
+    await set_state(chat_id, "booking", "service", {})
+    await send_message(chat_id, f"{prefix}{texts['booking_prompt']}")
+
 
+async def menu_ask(chat_id, lang, texts, prefix):
+    await send_message(chat_id, texts["ask_prompt"], reply_markup=main_keyboard(lang))
+
+
+# Indexed by the button's position in the flattened main keyboard (BUTTON_INDEX)
+MENU_HANDLERS = (
+    menu_reply("services_reply"),
+    menu_reply("hours_reply"),
+    menu_booking,
+    menu_reply("address_reply"),
+    menu_ask,
+)
+
+
+async def handle_update(data):
     msg = data.get("message", {})
     chat_id = msg.get("chat", {}).get("id")
     text = (msg.get("text") or "").strip()
 
     if not chat_id:
-        return {"ok": True}
+        return
 
     # Admin broadcast
     if str(chat_id) == str(ADMIN_CHAT_ID) and text.startswith("/broadcast"):
         body = text.replace("/broadcast", "").strip()
-        users = get_all_users()
+        users = await get_all_users()
         for u in users:
-            await send_message(u, "📢 " + body)
+            queue_message(u, "📢 " + body)
         # Admin message in English
         await send_message(chat_id, f"Sent to {len(users)} users.")
-        return {"ok": True}
-
-    # Load state
-    with sqlite3.connect(DB_NAME) as conn:
-        state_row = conn.execute(
-            "SELECT flow_type, step, data FROM states WHERE chat_id=?", (chat_id,)
-        ).fetchone()
-        current_state = (
-            {
-                "flow_type": state_row[0],
-                "step": state_row[1],
-                "data": json.loads(state_row[2]) if state_row[2] else {},
-            }
-            if state_row
-            else None
-        )
+        return
+
+    # Load user and state
+    user_row, state_row = await load_context(chat_id)
+    current_state = (
+        {
+            "flow_type": state_row[0],
+            "step": state_row[1],
+            "data": orjson.loads(state_row[2]) if state_row[2] else {},
+        }
+        if state_row
+        else None
+    )
 
-    user_row = get_user(chat_id)
     user_name = user_row[0] if user_row else None
     lang = user_row[3] if user_row else "en"
     texts = TRANS.get(lang, TRANS["en"])
 
     # Global interceptor: reset state if user pressed any main menu button
-    all_menu_btns = get_all_menu_buttons()
-    if text in all_menu_btns:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-            conn.commit()
+    if text in MENU_BUTTONS:
+        await clear_state(chat_id)
         current_state = None
 
     # Image (teledentistry)
     if msg.get("photo"):
         if not user_row:
             # Try to infer language from state if available
-            guessed_lang = "en"
-            if state_row and state_row[2]:
-                try:
-                    sd = json.loads(state_row[2])
-                    guessed_lang = sd.get("lang", "en")
-                except Exception:
-                    pass
+            guessed_lang = current_state["data"].get("lang", "en") if current_state else "en"
             t = TRANS.get(guessed_lang, TRANS["en"])
             await send_message(chat_id, t["please_register_first"])
-            return {"ok": True}
+            return
 
-        if msg["photo"][-1].get("file_size", 0) > 19 * 1024 * 1024:
+        # Telegram sends every resolution inline, smallest first. file_size is
+        # optional, so only drop sizes known to be over the cap and rank the rest
+        # by resolution; ties (or no dimensions) fall back to the last one.
+        fitting = [p for p in msg["photo"] if p.get("file_size", 0) <= MAX_PHOTO_BYTES]
+        if not fitting:
             await send_message(chat_id, texts["file_too_large"])
-            return {"ok": True}
+            return
+        photo = max(reversed(fitting), key=lambda p: p.get("width", 0) * p.get("height", 0))
 
-        await send_message(chat_id, texts["photo_analyzing"])
-        f_info = await get_file_info(msg["photo"][-1]["file_id"])
+        # Let the "analyzing" notice go out while the image is fetched and analyzed
+        notice = asyncio.create_task(send_message(chat_id, texts["photo_analyzing"]))
+        f_info = await get_file_info(photo["file_id"])
         if f_info:
             res = await analyze_image_with_gemini(
                 f_info["file_path"], msg.get("caption", ""), lang
             )
+            await notice
             prefix = texts["greeting"].format(name=user_name)
             await send_message(
                 chat_id,
@@ -571,8 +923,9 @@ async def webhook(request: Request):
                 reply_markup=main_keyboard(lang),
             )
         else:
+            await notice
             await send_message(chat_id, "❌ Failed to get file from Telegram.")
-        return {"ok": True}
+        return
 
     # Contact verification during registration
     if current_state and current_state["step"] == "phone":
@@ -588,18 +941,16 @@ async def webhook(request: Request):
                     state_texts["not_your_contact"],
                     reply_markup=contact_keyboard(state_lang),
                 )
-                return {"ok": True}
+                return
 
-            upsert_user(
+            await upsert_user(
                 chat_id,
                 name=data_state.get("name"),
                 whatsapp=data_state.get("whatsapp"),
                 phone=contact.get("phone_number"),
                 lang=state_lang,
+                clear_state=True,
             )
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                conn.commit()
 
             welcome_msg = state_texts["reg_complete"]
             await send_message(
@@ -611,17 +962,12 @@ async def webhook(request: Request):
                 state_texts["use_button_error"],
                 reply_markup=contact_keyboard(state_lang),
             )
-        return {"ok": True}
+        return
 
     # /start command
     if text == "/start":
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-            conn.execute(
-                "INSERT INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
-                (chat_id, "reg", "lang", "{}"),
-            )
-            conn.commit()
+        # INSERT OR REPLACE already drops any previous flow
+        await set_state(chat_id, "reg", "lang", {})
 
         start_msg = (
             "Please select language:\n"
@@ -631,7 +977,7 @@ async def webhook(request: Request):
             "• Русский / Russian"
         )
         await send_message(chat_id, start_msg, reply_markup=language_keyboard())
-        return {"ok": True}
+        return
 
     # Registration flow
     if current_state and current_state["flow_type"] == "reg":
@@ -639,16 +985,7 @@ async def webhook(request: Request):
         data_state = current_state["data"]
 
         if step == "lang":
-            sel_lang = None
-            t_l = text.lower()
-            if "فارسی" in text:
-                sel_lang = "fa"
-            elif "english" in t_l:
-                sel_lang = "en"
-            elif "arabic" in t_l or "العربية" in text:
-                sel_lang = "ar"
-            elif "russian" in t_l or "русский" in text:
-                sel_lang = "ru"
+            sel_lang = detect_language(text)
 
             if not sel_lang:
                 # Multi-language message since language not selected yet
@@ -659,186 +996,113 @@ async def webhook(request: Request):
                     "Пожалуйста, выберите один из вариантов ниже."
                 )
                 await send_message(chat_id, msg_lang, reply_markup=language_keyboard())
-                return {"ok": True}
+                return
 
-            upsert_user(chat_id, lang=sel_lang)
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("name", json.dumps({"lang": sel_lang}), chat_id),
-                )
-                conn.commit()
+            await upsert_user(chat_id, lang=sel_lang)
+            await update_state(chat_id, "name", {"lang": sel_lang})
 
             await send_message(
                 chat_id,
                 TRANS[sel_lang]["name_prompt"],
                 reply_markup={"remove_keyboard": True},
             )
-            return {"ok": True}
+            return
+
+        reg_texts = TRANS.get(data_state.get("lang"), TRANS["en"])
 
         if step == "name":
-            if text.strip() in [
-                "English",
-                "فارسی / Farsi",
-                "العربية / Arabic",
-                "Русский / Russian",
-            ]:
-                await send_message(chat_id, TRANS[data_state["lang"]]["name_error"])
-                return {"ok": True}
-
-            data_state["name"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("whatsapp", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
-            await send_message(chat_id, TRANS[data_state["lang"]]["whatsapp_prompt"])
-            return {"ok": True}
+            if text.strip() in LANG_BUTTONS:
+                await send_message(chat_id, reg_texts["name_error"])
+                return
+
+            await update_state(chat_id, "whatsapp", {"name": text})
+            await send_message(chat_id, reg_texts["whatsapp_prompt"])
+            return
 
         if step == "whatsapp":
-            data_state["whatsapp"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("phone", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
+            data_state = await update_state(chat_id, "phone", {"whatsapp": text})
             await send_message(
                 chat_id,
-                TRANS[data_state["lang"]]["phone_prompt"],
+                reg_texts["phone_prompt"],
                 reply_markup=contact_keyboard(data_state["lang"]),
             )
-            return {"ok": True}
+            return
 
     # If user not registered at this point
     if not user_row:
         # We may not know language yet, so use English text
         base_texts = TRANS["en"]
         await send_message(chat_id, base_texts["type_start_to_register"])
-        return {"ok": True}
+        return
 
     # Booking flow
     if current_state and current_state["flow_type"] == "booking":
         step = current_state["step"]
-        data_state = current_state["data"]
 
         # Cancel booking
         if text.strip().lower() == texts["cancel_button"].strip().lower():
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                conn.commit()
+            await clear_state(chat_id)
             await send_message(
                 chat_id, texts["cancelled"], reply_markup=main_keyboard(lang)
             )
-            return {"ok": True}
+            return
 
         if step == "service":
-            data_state["service"] = text
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("doctor", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
+            await update_state(chat_id, "doctor", {"service": text})
             await send_message(chat_id, texts["doctor_prompt"])
-            return {"ok": True}
+            return
 
         if step == "doctor":
-            data_state["doctor"] = text
-            slots = get_available_slots()
+            slots = await get_available_slots()
             if not slots:
-                with sqlite3.connect(DB_NAME) as conn:
-                    conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                    conn.commit()
+                await clear_state(chat_id)
                 await send_message(
                     chat_id, texts["no_slots"], reply_markup=main_keyboard(lang)
                 )
-                return {"ok": True}
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "UPDATE states SET step=?, data=? WHERE chat_id=?",
-                    ("slot", json.dumps(data_state), chat_id),
-                )
-                conn.commit()
+                return
+            # Remember what was offered so the tap maps straight back to a slot
+            await update_state(chat_id, "slot", {"doctor": text, "offered_slots": slots})
             await send_message(
                 chat_id,
                 texts["time_prompt"],
-                reply_markup=slots_keyboard(slots, lang),
+                reply_markup=slots_keyboard(tuple(slots), lang),
             )
-            return {"ok": True}
+            return
 
         if step == "slot":
             clicked_slot = text.strip()
-            full_slot = None
-            with sqlite3.connect(DB_NAME) as conn:
-                found = conn.execute(
-                    "SELECT datetime_str FROM slots WHERE datetime_str LIKE ? AND is_booked=0",
-                    (f"%{clicked_slot}",),
-                ).fetchone()
-                if found:
-                    full_slot = found[0]
-
-            if full_slot and book_slot_atomic(full_slot, chat_id):
-                with sqlite3.connect(DB_NAME) as conn:
-                    conn.execute("DELETE FROM states WHERE chat_id=?", (chat_id,))
-                    conn.commit()
+            offered = {s[5:]: s for s in current_state["data"].get("offered_slots", [])}
+            full_slot = offered.get(clicked_slot)
+            booked = await book_slot_atomic(full_slot, chat_id) if full_slot else None
+
+            if booked:
                 await send_message(
                     chat_id, texts["booking_done"], reply_markup=main_keyboard(lang)
                 )
                 if ADMIN_CHAT_ID:
                     try:
-                        await send_message(
+                        queue_message(
                             int(ADMIN_CHAT_ID),
                             f"📅 Booking:\nName: {user_name}\nWA: {user_row[1]}\nTime: {full_slot}",
                         )
                     except Exception:
                         pass
             else:
-                new_slots = get_available_slots()
+                new_slots = await get_available_slots()
+                await update_state(chat_id, "slot", {"offered_slots": new_slots})
                 await send_message(
                     chat_id,
                     texts["slot_taken"],
-                    reply_markup=slots_keyboard(new_slots, lang),
+                    reply_markup=slots_keyboard(tuple(new_slots), lang),
                 )
-            return {"ok": True}
+            return
 
     # Main menu handling
-    flat_btns = [b for r in texts["buttons"] for b in r]
-    if text in flat_btns:
-        idx = flat_btns.index(text)
+    idx = BUTTON_INDEX.get(lang, BUTTON_INDEX["en"]).get(text)
+    if idx is not None:
         prefix = texts["greeting"].format(name=user_name)
-        if idx == 0:
-            await send_message(
-                chat_id,
-                f"{prefix}\n{texts['services_reply']}",
-                reply_markup=main_keyboard(lang),
-            )
-        elif idx == 1:
-            await send_message(
-                chat_id,
-                f"{prefix}\n{texts['hours_reply']}",
-                reply_markup=main_keyboard(lang),
-            )
-        elif idx == 2:
-            with sqlite3.connect(DB_NAME) as conn:
-                conn.execute(
-                    "INSERT OR REPLACE INTO states (chat_id, flow_type, step, data) VALUES (?,?,?,?)",
-                    (chat_id, "booking", "service", "{}"),
-                )
-                conn.commit()
-            await send_message(chat_id, f"{prefix}{texts['booking_prompt']}")
-        elif idx == 3:
-            await send_message(
-                chat_id,
-                f"{prefix}\n{texts['address_reply']}",
-                reply_markup=main_keyboard(lang),
-            )
-        elif idx == 4:
-            await send_message(
-                chat_id, texts["ask_prompt"], reply_markup=main_keyboard(lang)
-            )
-        return {"ok": True}
+        await MENU_HANDLERS[idx](chat_id, lang, texts, prefix)
+        return
 
     # AI chat fallback
     gemini_ans = await ask_gemini_text(text, lang)
@@ -846,5 +1110,3 @@ async def webhook(request: Request):
     await send_message(
         chat_id, f"{prefix}{gemini_ans}", reply_markup=main_keyboard(lang)
     )
-
-    return {"ok": True}